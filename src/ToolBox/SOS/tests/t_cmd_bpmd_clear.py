@@ -19,8 +19,7 @@ def runScenario(assembly, debugger, target):
     ci.HandleCommand("bpmd " + assembly + " Test.UnlikelyInlined", res)
     out_msg = res.GetOutput()
     err_msg = res.GetError()
-    print(out_msg)
-    print(err_msg)
+    test.print_output(out_msg, err_msg)
     # Interpreter must have this command and able to run it
     test.assertTrue(res.Succeeded())
 
@@ -36,8 +35,7 @@ def runScenario(assembly, debugger, target):
     ci.HandleCommand("bpmd -clear 1", res)
     out_msg = res.GetOutput()
     err_msg = res.GetError()
-    print(out_msg)
-    print(err_msg)
+    test.print_output(out_msg, err_msg)
     # Interpreter must have this command and able to run it
     test.assertTrue(res.Succeeded())
 
@@ -22,8 +22,7 @@ def runScenario(assembly, debugger, target):
     ci.HandleCommand("bpmd -nofuturemodule " + assembly + " Test.Main", res)
     out_msg = res.GetOutput()
     err_msg = res.GetError()
-    print(out_msg)
-    print(err_msg)
+    test.print_output(out_msg, err_msg)
     # Interpreter must have this command and able to run it
     test.assertTrue(res.Succeeded())
 
@@ -13,8 +13,7 @@ def runScenario(assembly, debugger, target):
     test.stop_in_main(debugger, assembly)
 
     ci.HandleCommand("clrstack", res)
-    print(res.GetOutput())
-    print(res.GetError())
+    test.print_output(res.GetOutput(), res.GetError())
     # Interpreter must have this command and able to run it
     test.assertTrue(res.Succeeded())
 
@@ -13,8 +13,7 @@ def runScenario(assembly, debugger, target):
     test.stop_in_main(debugger, assembly)
 
     ci.HandleCommand("name2ee " + assembly + " Test.Main", res)
-    print(res.GetOutput())
-    print(res.GetError())
+    test.print_output(res.GetOutput(), res.GetError())
     # Interpreter must have this command and able to run it
     test.assertTrue(res.Succeeded())
 
@@ -35,8 +34,7 @@ def runScenario(assembly, debugger, target):
     test.assertTrue(test.is_hexnum(md_addr))
 
     ci.HandleCommand("dumpmd " + md_addr, res)
-    print(res.GetOutput())
-    print(res.GetError())
+    test.print_output(res.GetOutput(), res.GetError())
     # Interpreter must have this command and able to run it
     test.assertTrue(res.Succeeded())
 
@@ -57,8 +55,7 @@ def runScenario(assembly, debugger, target):
     test.assertTrue(test.is_hexnum(class_addr))
 
     ci.HandleCommand("dumpmd " + class_addr, res)
-    print(res.GetOutput())
-    print(res.GetError())
+    test.print_output(res.GetOutput(), res.GetError())
     # Interpreter must have this command and able to run it
     test.assertTrue(res.Succeeded())
 
@@ -15,13 +15,12 @@ def runScenario(assembly, debugger, target):
     md_addr = test.get_methoddesc(debugger, assembly, "Test.DumpIL")
 
     ci.HandleCommand("dumpil " + md_addr, res)
-    print(res.GetOutput())
-    print(res.GetError())
+    test.print_output(res.GetOutput(), res.GetError())
     # Interpreter must have this command and able to run it
     test.assertTrue(res.Succeeded())
 
     insts = res.GetOutput()
-    print(insts)
+    test.print_output(insts)
     # Function must have some instructions
     test.assertTrue(len(insts) > 0)
 
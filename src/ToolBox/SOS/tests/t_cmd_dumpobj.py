@@ -13,8 +13,7 @@ def runScenario(assembly, debugger, target):
     test.stop_in_main(debugger, assembly)
 
     ci.HandleCommand("dso", res)
-    print(res.GetOutput())
-    print(res.GetError())
+    test.print_output(res.GetOutput(), res.GetError())
     # Interpreter must have this command and able to run it
     test.assertTrue(res.Succeeded())
 
@@ -43,8 +42,7 @@ def runScenario(assembly, debugger, target):
 
     for obj in objects:
         ci.HandleCommand("dumpobj " + obj, res)
-        print(res.GetOutput())
-        print(res.GetError())
+        test.print_output(res.GetOutput(), res.GetError())
         # Interpreter must have this command and able to run it
         test.assertTrue(res.Succeeded())
 
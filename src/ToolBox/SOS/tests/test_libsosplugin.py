@@ -1,10 +1,12 @@
 from __future__ import print_function
 import unittest
 import argparse
+import collections
 import re
 import tempfile
 import subprocess
-import threading
+import multiprocessing.pool
+import glob
 import os
 import sys
 import inspect
@@ -15,67 +17,89 @@ workdir = ''
 corerun = ''
 sosplugin = ''
 assembly = ''
-fail_flag = ''
-fail_flag_lldb = ''
-summary_file = ''
+fail_flag_base = ''
+summary_file_base = ''
 timeout = 0
 regex = ''
 repeat = 0
+jobs = 1
+batch = 1
 
 
-def runWithTimeout(cmd):
-    p = None
+def _rm(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
 
-    def run():
-        global p
-        p = subprocess.Popen(cmd, shell=True)
-        p.communicate()
+# Runs tests in a thread pool; each one just waits for its own lldb
+class ParallelTestSuite(unittest.TestSuite):
 
-    thread = threading.Thread(target=run)
-    thread.start()
+    def __init__(self, tests=(), jobs=1):
+        super(ParallelTestSuite, self).__init__(tests)
+        self.jobs = jobs
 
-    thread.join(timeout)
-    if thread.is_alive():
-        with open(summary_file, 'a+') as summary:
-            print('Timeout!', file=summary)
-        p.kill()
-        thread.join()
+    def run(self, result):
+        def run_test(test):
+            if not result.shouldStop:
+                test(result)
+
+        pool = multiprocessing.pool.ThreadPool(self.jobs)
+        try:
+            pool.map(run_test, self, chunksize=1)
+        except BaseException:
+            # Do not start the queued tests, e.g. on Ctrl-C
+            pool.terminate()
+            raise
+        pool.close()
+        pool.join()
+        return result
 
 
 class TestSosCommands(unittest.TestCase):
 
-    def do_test(self, command):
-        open(fail_flag, 'a').close()
-        try:
-            os.unlink(fail_flag_lldb)
-        except:
-            pass
-
-        cmd = (('%s -b ' % lldb) +
-               ("-k \"script open('%s', 'a').close()\" " % fail_flag_lldb) +
-               ("-k 'quit' ") +
-               ("--no-lldbinit ") +
-               ("-O \"plugin load %s \" " % sosplugin) +
-               ("-o \"script import testutils as test\" ") +
-               ("-o \"script test.fail_flag = '%s'\" " % fail_flag) +
-               ("-o \"script test.summary_file = '%s'\" " % summary_file) +
-               ("-o \"script test.run('%s', '%s')\" " % (assembly, command)) +
-               ("-o \"quit\" ") +
-               (" -- %s %s > %s.log 2> %s.log.2" % (corerun, assembly,
-                                                    command, command)))
-
-        runWithTimeout(cmd)
-        self.assertFalse(os.path.isfile(fail_flag))
-        self.assertFalse(os.path.isfile(fail_flag_lldb))
+    def do_test(self, *commands):
+        # All scenarios are run by a single lldb process. Logs, flags
+        # and summary are named after the first one, so that tests
+        # running in parallel do not interfere with each other
+        command = commands[0]
+        fail_flag = fail_flag_base + '.' + command
+        fail_flag_lldb = fail_flag + '.lldb'
+        summary_file = summary_file_base + '.' + command
 
-        try:
-            os.unlink(fail_flag)
-        except:
-            pass
-        try:
-            os.unlink(fail_flag_lldb)
-        except:
-            pass
+        open(fail_flag, 'a').close()
+        _rm(fail_flag_lldb)
+
+        cmd = [lldb, '-b',
+               '-k', "script open(%r, 'a').close()" % fail_flag_lldb,
+               '-k', 'quit',
+               '--no-lldbinit',
+               '-O', 'plugin load %s' % sosplugin,
+               '-o', 'script import testutils as test',
+               '-o', 'script test.fail_flag = %r' % fail_flag,
+               '-o', 'script test.summary_file = %r' % summary_file,
+               '-o', 'script test.run(%r, %r)' % (assembly, list(commands)),
+               '-o', 'quit',
+               '--', corerun, assembly]
+
+        with open('%s.log' % command, 'w') as stdout, \
+                open('%s.log.2' % command, 'w') as stderr:
+            try:
+                # subprocess.run kills and reaps lldb on timeout
+                p = subprocess.run(cmd, stdout=stdout, stderr=stderr,
+                                   timeout=timeout * len(commands))
+                status = 'lldb exited with code %i' % p.returncode
+            except subprocess.TimeoutExpired:
+                with open(summary_file, 'a+') as summary:
+                    print('Timeout!', file=summary)
+                status = 'lldb timed out'
+
+        self.assertFalse(os.path.isfile(fail_flag), status)
+        self.assertFalse(os.path.isfile(fail_flag_lldb), status)
+
+        _rm(fail_flag)
+        _rm(fail_flag_lldb)
 
     def t_cmd_bpmd_nofuturemodule_module_function(self):
         self.do_test('t_cmd_bpmd_nofuturemodule_module_function')
@@ -171,34 +195,60 @@ class TestSosCommands(unittest.TestCase):
         self.do_test('t_cmd_soshelp')
 
 
-def generate_report():
-    report = [{'name': 'TOTAL', True: 0, False: 0, 'completed': True}]
+# Runs several scenarios of TestSosCommands in one lldb process
+class TestSosBatch(TestSosCommands):
+
+    def __init__(self, commands):
+        super(TestSosBatch, self).__init__('run_batch')
+        self.commands = commands
+
+    def run_batch(self):
+        self.do_test(*self.commands)
+
+    def __str__(self):
+        return 'batch (%s)' % ', '.join(self.commands)
+
+
+def generate_report(batches):
+    report = collections.defaultdict(
+        lambda: {'pass': 0, 'fail': 0, 'completed': False, 'timeout': False})
+    total = {'pass': 0, 'fail': 0}
     fail_messages = []
 
-    if not os.path.isfile(summary_file):
-        print('No summary file to process!')
-        return
-
-    with open(summary_file, 'r') as summary:
-        for line in summary:
-            if line.startswith('new_suite: '):
-                report.append({'name': line.split()[-1], True: 0, False: 0,
-                               'completed': False, 'timeout': False})
-            elif line.startswith('True'):
-                report[-1][True] += 1
-            elif line.startswith('False'):
-                report[-1][False] += 1
-            elif line.startswith('Completed!'):
-                report[-1]['completed'] = True
-            elif line.startswith('Timeout!'):
-                report[-1]['timeout'] = True
-            elif line.startswith('!!! '):
-                fail_messages.append(line.rstrip('\n'))
-
-    for suite in report[1:]:
-        report[0][True] += suite[True]
-        report[0][False] += suite[False]
-        report[0]['completed'] &= suite['completed']
+    # Summary lines that update a counter or a flag of the current suite
+    counters = {'True': 'pass', 'False': 'fail'}
+    flags = {'Completed!': 'completed', 'Timeout!': 'timeout'}
+
+    for commands in batches:
+        # Lines written before the first suite starts (e.g. a timeout while
+        # lldb is loading) belong to the scenario the batch is named after
+        suite = commands[0]
+        started = set()
+        timed_out = False
+        summary_file = summary_file_base + '.' + suite
+        if os.path.isfile(summary_file):
+            with open(summary_file, 'r') as summary:
+                for line in summary:
+                    line = line.rstrip('\n')
+                    tag, _, arg = line.partition(' ')
+                    if tag == 'new_suite:':
+                        suite = arg
+                        started.add(suite)
+                        report[suite]['completed'] = False
+                    elif tag in counters:
+                        report[suite][counters[tag]] += 1
+                        total[counters[tag]] += 1
+                    elif tag in flags:
+                        report[suite][flags[tag]] = True
+                        timed_out |= tag == 'Timeout!'
+                    elif tag == '!!!':
+                        fail_messages.append(line)
+
+        # Scenarios the batch never got to share the fate of the one
+        # that crashed or timed out before them
+        for command in commands:
+            if command not in started:
+                report[command]['timeout'] |= timed_out
 
     for line in fail_messages:
         print(line)
@@ -207,18 +257,20 @@ def generate_report():
     print('=' * 79)
     print('{:72} {:6}'.format('Test suite', 'Result'))
     print('-' * 79)
-    for suite in report[1:]:
+    for name, suite in report.items():
         if suite['timeout']:
             result = 'Timeout'
-        elif suite[False]:
+        elif suite['fail']:
             result = 'Fail'
         elif not suite['completed']:
             result = 'Crash'
-        elif suite[True]:
+        elif suite['pass']:
             result = 'Success'
         else:
             result = 'Please, report'
-        print('{:68} {:>10}'.format(suite['name'], result))
+        print('{:68} {:>10}'.format(name, result))
+    print('-' * 79)
+    print('Checks passed: %i, failed: %i' % (total['pass'], total['fail']))
     print('=' * 79)
 
 
@@ -231,6 +283,8 @@ if __name__ == '__main__':
     parser.add_argument('--timeout', default=90)
     parser.add_argument('--regex', default='t_cmd_')
     parser.add_argument('--repeat', default=1)
+    parser.add_argument('--jobs', default=multiprocessing.cpu_count())
+    parser.add_argument('--batch', default=1)
     parser.add_argument('unittest_args', nargs='*')
 
     args = parser.parse_args()
@@ -242,6 +296,8 @@ if __name__ == '__main__':
     timeout = int(args.timeout)
     regex = args.regex
     repeat = int(args.repeat)
+    jobs = int(args.jobs)
+    batch = int(args.batch)
     print("lldb: %s" % lldb)
     print("clrdir: %s" % clrdir)
     print("workdir: %s" % workdir)
@@ -249,6 +305,8 @@ if __name__ == '__main__':
     print("timeout: %i" % timeout)
     print("regex: %s" % regex)
     print("repeat: %i" % repeat)
+    print("jobs: %i" % jobs)
+    print("batch: %i" % batch)
 
     corerun = os.path.join(clrdir, 'corerun')
     sosplugin = os.path.join(clrdir, 'libsosplugin.so')
@@ -259,26 +317,30 @@ if __name__ == '__main__':
     print("corerun: %s" % corerun)
     print("sosplugin: %s" % sosplugin)
 
-    fail_flag = os.path.join(workdir, 'fail_flag')
-    fail_flag_lldb = os.path.join(workdir, 'fail_flag.lldb')
+    fail_flag_base = os.path.join(workdir, 'fail_flag')
+    print("fail_flag: %s.*" % fail_flag_base)
 
-    print("fail_flag: %s" % fail_flag)
-    print("fail_flag_lldb: %s" % fail_flag_lldb)
+    summary_file_base = os.path.join(workdir, 'summary')
+    print("summary_file: %s.*" % summary_file_base)
 
-    summary_file = os.path.join(workdir, 'summary')
-    print("summary_file: %s" % summary_file)
-
-    try:
-        os.unlink(summary_file)
-    except:
-        pass
+    for f in glob.glob(summary_file_base + '.*'):
+        _rm(f)
 
     sys.argv[1:] = args.unittest_args
-    suite = unittest.TestSuite()
-    all_tests = inspect.getmembers(TestSosCommands, predicate=inspect.ismethod)
-    for (test_name, test_func) in all_tests:
-        if re.match(regex, test_name):
-            suite.addTest(TestSosCommands(test_name))
+    suite = ParallelTestSuite(jobs=jobs)
+    all_tests = inspect.getmembers(TestSosCommands,
+                                   predicate=inspect.isfunction)
+    test_names = [test_name for (test_name, test_func) in all_tests
+                  if re.match(regex, test_name)]
+    # Test methods are named after the scenarios they run
+    batch = max(batch, 1)
+    batches = [test_names[i:i + batch]
+               for i in range(0, len(test_names), batch)]
+    for commands in batches:
+        if len(commands) > 1:
+            suite.addTest(TestSosBatch(commands))
+        else:
+            suite.addTest(TestSosCommands(commands[0]))
     unittest.TextTestRunner(verbosity=1).run(suite)
 
-    generate_report()
+    generate_report(batches)
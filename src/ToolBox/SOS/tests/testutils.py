@@ -1,33 +1,64 @@
 from __future__ import print_function
 import lldb
 import re
-import inspect
+import linecache
 import sys
 import os
 import importlib
+import atexit
+import traceback
 
 summary_file = ''
 fail_flag = ''
 
 failed = False
 
+verbose = os.environ.get('SOS_TEST_VERBOSE') == '1'
+
+_summary = None
+_regexes = {}
+
+# Source files of the scenarios, where a failure report stops unwinding
+_scenario_files = set(
+    f for f in os.listdir(os.path.dirname(os.path.abspath(__file__)))
+    if re.match(r't_\w+\.py$', f))
+
+
+def write_summary(line, flush=False):
+    # summary_file is assigned by the test driver after this module is
+    # imported, so the file is opened on first use and then kept open.
+    # Writes are buffered; callers flush whatever must survive a crash.
+    global _summary
+    if _summary is None:
+        _summary = open(summary_file, 'a', 8192)
+        atexit.register(_summary.close)
+    _summary.write(line + '\n')
+    if flush:
+        _summary.flush()
+
 
 def assertCommon(passed, fatal):
     global failed
-    with open(summary_file, 'a+') as summary:
-        print(bool(passed), file=summary)
-        if (not passed):
-            failed = True
-            print('!!! test failed:', file=summary)
-            for s in inspect.stack()[2:]:
-                print("!!!  %s:%i" % (s[1], s[2]), file=summary)
-                print("!!! %s" % s[4][0], file=summary)
-                if re.match('\W*t_\w+\.py$', s[1]):
-                    break
-            print('!!! ', file=summary)
-
-            if fatal:
-                exit(1)
+    write_summary(str(bool(passed)))
+    if passed:
+        return
+
+    failed = True
+    write_summary('!!! test failed:')
+    frame = sys._getframe(2)
+    while frame:
+        filename = frame.f_code.co_filename
+        lineno = frame.f_lineno
+        write_summary("!!!  %s:%i" % (filename, lineno))
+        write_summary("!!! %s" %
+                      linecache.getline(filename, lineno).rstrip('\n'))
+        if os.path.basename(filename) in _scenario_files:
+            break
+        frame = frame.f_back
+    write_summary('!!! ', flush=True)
+
+    if fatal:
+        exit(1)
 
 
 def assertTrue(x, fatal=True):
@@ -54,6 +85,12 @@ def assertNotEqual(x, y, fatal=True):
     assertCommon(passed, fatal)
 
 
+def print_output(*messages):
+    # Command output can be large, so it is only echoed on request
+    if verbose:
+        sys.stdout.write(''.join('%s\n' % m for m in messages))
+
+
 def checkResult(res):
     if not res.Succeeded():
         print(res.GetOutput())
@@ -74,18 +111,32 @@ def exec_and_find(commandInterpreter, cmd, regexp):
     commandInterpreter.HandleCommand(cmd, res)
     checkResult(res)
 
-    expr = re.compile(regexp)
+    expr = _regexes.get(regexp)
+    if expr is None:
+        expr = re.compile(regexp)
+        _regexes[regexp] = expr
     addr = None
 
-    print(res.GetOutput())
-    lines = res.GetOutput().splitlines()
-    for line in lines:
-        match = expr.match(line)
+    output = res.GetOutput()
+    print_output(output)
+
+    # Match regexp at the beginning of each line of the output
+    # without splitting the output into a list of lines
+    pos = 0
+    while pos < len(output):
+        end = output.find('\n', pos)
+        if end < 0:
+            end = len(output)
+        next_pos = end + 1
+        if end > pos and output[end - 1] == '\r':
+            end -= 1
+        match = expr.match(output, pos, end)
         if match:
             addr = match.group(1)
             break
+        pos = next_pos
 
-    print("Found addr: " + str(addr))
+    print_output("Found addr: " + str(addr))
     return addr
 
 
@@ -107,8 +158,7 @@ def stop_in_main(debugger, assembly):
     ci.HandleCommand("bpmd " + assembly + " Test.Main", res)
     out_msg = res.GetOutput()
     err_msg = res.GetError()
-    print(res.GetOutput())
-    print(res.GetError())
+    print_output(res.GetOutput(), res.GetError())
     # Interpreter must have this command and able to run it
     assertTrue(res.Succeeded())
 
@@ -137,8 +187,7 @@ def exit_lldb(debugger, assembly):
     ci.HandleCommand("breakpoint delete --force", res)
     out_msg = res.GetOutput()
     err_msg = res.GetError()
-    print(out_msg)
-    print(err_msg)
+    print_output(out_msg, err_msg)
     # Interpreter must have this command and able to run it
     # assertTrue(res.Succeeded())
 
@@ -157,8 +206,7 @@ def get_methoddesc(debugger, assembly, funcname):
     res = lldb.SBCommandReturnObject()
 
     ci.HandleCommand("name2ee %s %s" % (assembly, funcname), res)
-    print(res.GetOutput())
-    print(res.GetError())
+    print_output(res.GetOutput(), res.GetError())
     # Interpreter must have this command and able to run it
     assertTrue(res.Succeeded())
 
@@ -181,26 +229,60 @@ def get_methoddesc(debugger, assembly, funcname):
     return md_addr
 
 
-def run(assembly, module):
-    with open(summary_file, 'a+') as summary:
-        print('new_suite: %s' % module, file=summary)
+def cleanup_process(debugger, target, keep_crashed=False):
+    # A failed scenario may leave its process and breakpoints behind,
+    # and pending bpmd breakpoints live in SOS across relaunches
+    process = target.GetProcess()
+    if process.IsValid() and process.GetState() != lldb.eStateExited:
+        stop_reason = process.GetSelectedThread().GetStopReason()
+        if not keep_crashed or stop_reason == lldb.eStopReasonBreakpoint:
+            process.Kill()
+            debugger.HandleCommand("breakpoint delete --force")
+    debugger.HandleCommand("bpmd -clearall")
+
 
+def run(assembly, modules):
     debugger = lldb.debugger
 
     debugger.SetAsync(False)
     target = lldb.target
 
-    debugger.HandleCommand("breakpoint set --one-shot --name coreclr_execute_assembly")
-    debugger.HandleCommand("process launch")
-
-    # run the scenario
-    print("starting scenario...")
-    i = importlib.import_module(module)
-    scenarioResult = i.runScenario(os.path.basename(assembly), debugger,
-                                   target)
-
-    if (target.GetProcess().GetExitStatus() == 0) and not failed:
+    # Scenarios run one after another in this lldb instance,
+    # each of them against a freshly launched process
+    passed = True
+    for module in modules:
+        write_summary('new_suite: %s' % module, flush=True)
+
+        cleanup_process(debugger, target)
+        debugger.HandleCommand("breakpoint set --one-shot --name coreclr_execute_assembly")
+        debugger.HandleCommand("process launch")
+
+        # run the scenario
+        print("starting scenario %s..." % module)
+        try:
+            i = sys.modules.get(module) or importlib.import_module(module)
+            i.runScenario(os.path.basename(assembly), debugger, target)
+        except SystemExit:
+            # A fatal check failed, go on with the next scenario
+            # leaving this one not completed
+            passed = False
+            continue
+        except Exception:
+            write_summary('!!! scenario %s raised:' % module)
+            for line in traceback.format_exc().splitlines():
+                write_summary('!!! %s' % line)
+            write_summary('!!! ', flush=True)
+            passed = False
+            continue
+
+        if target.GetProcess().GetExitStatus() != 0:
+            passed = False
+
+        write_summary('Completed!', flush=True)
+
+    # lldb must not quit with a process stopped at a breakpoint, but
+    # a crashed one is left for its crash hook to set fail_flag_lldb
+    cleanup_process(debugger, target, keep_crashed=True)
+
+    if passed and not failed:
         os.unlink(fail_flag)
-
-    with open(summary_file, 'a+') as summary:
-        print('Completed!', file=summary)